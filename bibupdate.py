@@ -26,13 +26,19 @@ Copyright (C) 2012, 2014
 '''
 
 ######################################################
-import itertools
+import collections
+import concurrent.futures
+import functools
+import hashlib
+import io
+import mmap
 import os
 import re
-import shutil
+import sqlite3
+import stat
 import sys
-import textwrap
-import urllib
+import threading
+import time
 
 ##########################################################
 # Define bibupdate's meta data. Used for global variables, to generate the
@@ -44,10 +50,11 @@ class Settings(dict):
     def __init__(self, ini_file):
         super(Settings, self).__init__(self)
         with open(ini_file) as ini:
-            for line in ini:
-                key, val = [w.strip() for w in line.split('=')]
-                if key != '':
-                    setattr(self, key.lower().strip(), val.strip())
+            for line in ini.read().splitlines():
+                # split on the first = so that values can contain an =, and skip other lines
+                key, equals, val = line.partition('=')
+                if equals and key.strip() != '':
+                    setattr(self, key.strip().lower(), val.strip())
 
 
 # The following meta data will be used to generate the __doc__ string below and
@@ -101,42 +108,62 @@ except (ImportError):
     print('Upgrade python or use easy_install or pip and to install argparse')
     sys.exit(1)
 
-# From python 2.7 onwards OrderedDict is in the standard collections library
+# import requests, which gives us a pool of keep-alive connections, and quit if we fail
 try:
-    from collections import OrderedDict
-except(ImportError):
-    try:
-        # in python 2.6 OrderedDict is in ordereddict
-        from  ordereddict import OrderedDict
-    except(ImportError):
-        # if we can't load Ordered revert to using dict
-        print('bibupdate prefers to use the ordered ordered dictionaries')
-        print('Upgrade python or use easy_install or pip and to install ordereddict')
-        OrderedDict=dict
+    import requests
+except (ImportError):
+    print('bibupdate needs to have the requests module installed')
+    print('Use easy_install or pip and to install requests')
+    sys.exit(1)
 
-# finally, try to import and use fuzzywuzzy.fuzz
+# finally, try to import and use rapidfuzz.fuzz
 try:
-    from fuzzywuzzy import fuzz
-    def good_match(one,two):
+    from rapidfuzz import fuzz, process
+    # the lowest ratio that good_matches accepts, which is used by possible_match
+    lowest_ratio=90
+    @functools.lru_cache(maxsize=4096)
+    def good_matches(title,titles):
         r"""
-        Returns True or False depending on whether or not the lower cased strings
-        `one` and `two` are a good (fuzzy) match for each other.
+        Returns a tuple of the indices of the strings in the tuple `titles` that
+        are a good (fuzzy) match for the string `title`. All of the titles
+        should already be lower cased. The words are sorted before they are
+        compared so titles that differ only in their word order still match.
+        rapidfuzz scores all of the titles in one call and the score_cutoff lets
+        it abandon comparisons that cannot score 90 or more. Repeated titles are
+        common in large bibtex files so the results are cached.
         """
-        return fuzz.ratio(one.lower(), two.lower())>90
+        return tuple(sorted(index for (ti, score, index) in process.extract(title, titles,
+                        scorer=fuzz.token_sort_ratio, processor=None, score_cutoff=90, limit=None)))
 except(ImportError):
-    print('bibupdate usually uses fuzzy matching to check the titles any matches.')
-    print('Unfortunately, this requires the fuzzywuzzy package which is not installed')
-    print('For more accurate matching use easy_install or pip and to install fuzzywuzzy')
-    def good_match(one,two):
-        return True
-
+    try:
+        # fall back to the slower fuzzywuzzy, which has the same fuzz.token_sort_ratio.
+        # Like rapidfuzz above, it is told not to process the titles. It rounds
+        # its ratios, so a title with a ratio of 89.5 is accepted
+        from fuzzywuzzy import fuzz
+        lowest_ratio=89.5
+        @functools.lru_cache(maxsize=4096)
+        def good_matches(title,titles):
+            return tuple(index for (index, ti) in enumerate(titles)
+                                   if fuzz.token_sort_ratio(title, ti, full_process=False)>=90)
+    except(ImportError):
+        print('bibupdate usually uses fuzzy matching to check the titles any matches.')
+        print('Unfortunately, this requires the rapidfuzz package which is not installed')
+        print('For more accurate matching use easy_install or pip and to install rapidfuzz')
+        lowest_ratio=90
+        def good_matches(title,titles):
+            return tuple(range(len(titles)))
+
+# the lookups are done in separate threads so we use a lock to stop their
+# messages from being interleaved
+log_lock=threading.Lock()
 def bib_print(*args):
     r"""
     Default printing mechanism. Defaults to sys.stdout but can be overridden
     by the command line options.
     """
-    for a in args:
-        options.log.write(a+'\n')
+    with log_lock:
+        for a in args:
+            options.log.write(a+'\n')
 
 def bib_error(*args):
     r"""
@@ -153,30 +180,189 @@ def bib_error(*args):
         sys.stderr.write(a+'\n')
     sys.exit(2)
 
+def no_op(*args):
+    r"""
+    Do nothing. Used for the messages that have been turned off.
+    """
+    pass
+
 ##########################################################
 
-# define a regular expression for extracting papers from BibTeX file
-bibtex_entry=re.compile('(@\s*[A-Za-z]*\s*{[^@]*})\s*',re.DOTALL)
+# the default number of lookups that are run at the same time, which can be
+# changed using --jobs, and the number of entries per lookup that can be
+# waiting to be written while these lookups finish
+lookup_threads=16
+lookup_window=4
+
+# A single session is shared by all of the lookups so that the connections to
+# the AMS are kept alive and reused. The connection pool of requests is thread
+# safe and process_options() makes it large enough to give each lookup thread
+# a connection.
+session=requests.Session()
+
+# The pages returned by the AMS are cached in an sqlite database, with one
+# row per query, so that rerunning bibupdate does not query the AMS again for
+# the same entries. Cached pages are reused until they are older than
+# cache_ttl seconds. The default location of the cache can be changed using
+# the --cache option, and --no-cache keeps the cache in memory.
+cache_file=os.path.expanduser(os.path.join('~', '.cache', 'bibupdate', 'mrlookup.sqlite'))
+cache_ttl=30*24*60*60
+cache_lock=threading.Lock()   # the lookup threads share one sqlite connection
+def open_cache(filename):
+    r"""
+    Return a connection to the sqlite database `filename` that caches the
+    pages returned by the AMS, creating the database if necessary.
+    """
+    if os.path.dirname(filename)!='':
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+    cache=sqlite3.connect(filename, check_same_thread=False)
+    cache.execute('CREATE TABLE IF NOT EXISTS pages (key BLOB PRIMARY KEY, time REAL, page TEXT)')
+    return cache
 
-# regular expression for cleaning TeX from title etc
-remove_tex=re.compile(r'[{}\'"_$]+')
-remove_mathematics=re.compile(r'\$[^\$]+\$')  # assume no nesting
-# savagely remove all maths from title
-clean_title=lambda title: remove_tex.sub('',remove_mathematics.sub('',title))
+def url_lookup(url, search):
+    r"""
+    Return the web page given by querying `url` with the dictionary `search`,
+    using the cached page in `bibup.cache` when it has not expired.
+    """
+    key=hashlib.sha1(repr((url, sorted(search.items()))).encode()).digest()
+    with cache_lock:
+        cached=bibup.cache.execute('SELECT time, page FROM pages WHERE key=?', (key,)).fetchone()
+    if cached is not None and time.time()-cached[0]<cache_ttl:
+        return cached[1]
+
+    response=session.post(url, data=search, timeout=30)
+    response.raise_for_status()     # never cache the AMS's error pages
+    page=response.text
+    with cache_lock:
+        bibup.cache.execute('INSERT OR REPLACE INTO pages VALUES (?, ?, ?)', (key, time.time(), page))
+    return page
+
+def closing_brace(text, pos, braces):
+    r"""
+    Return the position in `text` just after the brace that closes an opening
+    brace that comes before position `pos`, or None if the braces in `text`
+    are unbalanced. Here `braces` is a regular expression, of the same type
+    as `text`, that matches either an opening brace in its first group or a
+    closing brace.
+    """
+    depth=1
+    for brace in braces.finditer(text, pos):
+        depth+=-1 if brace.group(1) is None else 1
+        if depth==0:
+            return brace.end()
+    return None
 
 # to help in checking syntax define recognised/valid types of entries in a bibtex database
-bibtex_pub_types=['article', 'book', 'booklet', 'conference', 'inbook', 'incollection',
+bibtex_pub_types=frozenset(['article', 'book', 'booklet', 'conference', 'inbook', 'incollection',
                   'inproceedings', 'manual', 'mastersthesis', 'misc', 'phdthesis',
                   'proceedings', 'techreport', 'unpublished'
-]
+])
+
+# the types of entries that are looked up in the AMS databases
+ams_pub_types=frozenset(['article', 'book', 'incollection', 'inproceedings'])
+
+# the start of a BibTeX entry and the braces that we need to track when
+# scanning a BibTeX file for its entries. These are bytes patterns because
+# the BibTeX file is memory mapped.
+bibtex_start=re.compile(rb'@\s*([A-Za-z]*)\s*\{')
+bibtex_braces=re.compile(rb'(\{)|\}')
+def bibtex_entries(papers, pos=0):
+    r"""
+    Generator that yields the entries in the bytes-like object `papers`,
+    starting from position `pos`, which contains the contents of a BibTeX file
+    or a web page returned by the AMS. Each entry starts with an @ and ends
+    with the brace that closes the first opening brace after the @. As we
+    track the depth of the braces, @'s inside an entry, such as in email
+    addresses, are harmless and the file is scanned in a single pass.
+
+    Each entry is yielded as a tuple of strings (pub_type, cite_key, body),
+    where `body` contains the fields of the entry. If the entry is not one of
+    the bibtex_pub_types, such as @comment{...} or @string{...}, or it does not
+    have a citation key or its braces are unbalanced, then `cite_key` is None
+    and `body` is the whole entry. These entries are never parsed. Bytes that
+    are not valid UTF-8 are replaced with U+FFFD rather than stopping the run.
+    """
+    start=bibtex_start.search(papers, pos)
+    while start is not None:
+        end=closing_brace(papers, start.end(), bibtex_braces)
+        pub_type=start.group(1).decode('utf-8').lower()
+        if end is None:  # the braces are unbalanced so return the rest of the file
+            yield (pub_type, None, papers[start.start():].decode('utf-8', 'replace'))
+            return
+
+        if pub_type not in bibtex_pub_types:
+            yield (pub_type, None, papers[start.start():end].decode('utf-8', 'replace'))
+        else:
+            (cite_key, comma, body)=papers[start.end():end-1].decode('utf-8', 'replace').partition(',')
+            if comma=='' or '=' in cite_key:
+                yield (pub_type, None, papers[start.start():end].decode('utf-8', 'replace'))
+            else:
+                yield (pub_type, cite_key.strip(), body)
+        start=bibtex_start.search(papers, end)
+
+def read_papers(bibfile, newfile):
+    r"""
+    Return the contents of the open BibTeX file `bibfile` as a bytes-like
+    object. Normally the file is memory mapped so that the OS reads it in as
+    we need it, without copying it. Pipes, such as stdin, and empty files
+    cannot be mapped. Nor can the file be mapped if it is going to be
+    overwritten by `newfile`, because opening `newfile` truncates it. In these
+    cases the file is read into memory instead.
+    """
+    bibstat=os.fstat(bibfile.fileno())
+    overwritten=(newfile is not None and os.path.exists(newfile)
+                   and os.path.samestat(bibstat, os.stat(newfile)))
+    if stat.S_ISREG(bibstat.st_mode) and bibstat.st_size>0 and not overwritten:
+        return mmap.mmap(bibfile.fileno(), 0, access=mmap.ACCESS_READ)
+    return bibfile.buffer.read()
+
+# regular expression and translation table for cleaning TeX from title etc.
+# Deleting characters with str.translate is much faster than using re.sub
+remove_mathematics=re.compile(r'\$[^\$]+\$')  # assume no nesting
+remove_tex=str.maketrans('', '', '{}\'"_$')
+@functools.lru_cache(maxsize=4096)
+def clean_title(title):
+    r"""
+    Return `title` with its maths and TeX characters removed and its white
+    space collapsed. The same titles are cleaned many times so the cleaned
+    titles are cached.
+    """
+    if '$' in title:  # savagely remove all maths from title
+        title=remove_mathematics.sub('',title)
+    return ' '.join(title.translate(remove_tex).split())
+
+def possible_match(one, two):
+    r"""
+    Return False if the cleaned titles `one` and `two` are too different in
+    length for good_matches to accept them. fuzz.token_sort_ratio is
+    200*(matching characters)/(total length) of the sorted words and, as
+    clean_title collapses white space, sorting does not change the lengths of
+    the titles. Neither rapidfuzz nor fuzzywuzzy processes the titles first,
+    so no good match is rejected by checking only the lengths of the titles:
+
+    >>> possible_match('on hecke algebras', 'on heke algebra')
+    True
+    >>> possible_match('cellular algebras', 'celular algebra')
+    True
+    >>> possible_match('on hecke algebras', 'on hecke algebras and their representations')
+    False
+    """
+    return 200*min(len(one),len(two))>=lowest_ratio*(len(one)+len(two))
+
+# the page fields that mark an entry as a preprint
+preprint_pages=frozenset(['preprint', 'to appear', 'in preparation'])
 
 # need to massage some of the font specifications returned by mrlookup to "standard" latex fonts.
 fonts_to_replace={ 'Bbb' :'mathbb',
                    'scr' :'mathcal',
                    'germ':'mathfrak'
 }
-# a factory regular expression to replace expressions like \scr C and \scr{ Cat} in one hit
-font_replacer=re.compile(r'\\(%s)\s*(?:(\w)|\{([\s\w]*)\})' % '|'.join('%s'%f for f in fonts_to_replace.keys()))
+# a factory of regular expressions to replace expressions like \scr C and \scr{ Cat}
+# in one hit. Only one of the groups c and g matches, and the other one is
+# replaced with an empty string, so re.sub can use a template instead of a callback.
+# Each regular expression is only used if the title contains its font command.
+font_replacers=[('\\'+font, re.compile(r'\\%s\s*(?:(?P<c>\w)|\{(?P<g>[\s\w]*)\})' % font),
+                 r'\\%s{\g<c>\g<g>}' % fonts_to_replace[font]) for font in fonts_to_replace]
 def replace_fonts(string):
     r"""
     Return a new version of `string` with various fonts commands replaced with
@@ -188,7 +374,10 @@ def replace_fonts(string):
         - \scr X*  and \scr {X*}  --> \mathcal{X*}
         - \germ X* and \germ{X*}  --> \mathfrak{X*}
     """
-    return font_replacer.sub(lambda match : r'\%s{%s}' % (fonts_to_replace[match.group(1)],match.group(2) or match.group(3)), string)
+    for (command, font, replacement) in font_replacers:
+        if command in string:
+            string=font.sub(replacement, string)
+    return string
 
 # overkill for "type checking" of the wrap length command line option
 class NonnegativeIntegers(list):
@@ -209,14 +398,62 @@ class NonnegativeIntegers(list):
         """
         return isinstance(x,int) and x>=0
 
-class Bibtex(OrderedDict):
+# Regular expressions for scanning the keys and values of a bibtex entry. The
+# syntax here is very lax: we only assume that the braces inside a bibtex
+# field are balanced. From the AMS the format of a bibtex entry is much more
+# rigid but we cannot assume that an arbitrary bibtex file will respect the
+# AMS conventions.  There is a small complication in that we allow the value
+# of each field to either be enclosed in braces or to be a single word, and
+# we allow spaces around the equals signs.
+bibtex_key=re.compile(r'([A-Za-z]+)\s*=\s*')
+bibtex_word=re.compile(r'\w+')
+field_braces=re.compile(r'(\{)|\}')
+
+# For authors we match either "First Last" or "Last, First" with the
+# existence of the comma being the crucial test because we want to allow
+# compound surnames like De Morgan.
+author_name=re.compile(r'(?P<Au>[\w\s\\\-\'"{}]+),\s[A-Z]|[\w\s\\\-\'"{}]+\s(?P<au>[\w\s\\\-\'"{}]+)',re.DOTALL)
+author_separator=re.compile(r'\s+and\s+')
+
+def bibtex_fields(keys_and_vals):
+    r"""
+    Return a list of the (key, value) pairs of the fields in the string
+    `keys_and_vals`, which is the body of a bibtex entry. The keys are lower
+    cased and the fonts in the title are fixed. This is the inner loop when
+    reading a bibtex file so it is kept as a plain function of strings.
+    """
+    fields=[]
+    key=bibtex_key.search(keys_and_vals)
+    while key is not None:
+        start=key.end()
+        if keys_and_vals.startswith('{', start):
+            end=closing_brace(keys_and_vals, start+1, field_braces)
+            if end is None:
+                break                 # unbalanced braces so give up on the rest of the entry
+            val=' '.join(keys_and_vals[start+1:end-1].split()) # remove any internal space from val
+        else:
+            word=bibtex_word.match(keys_and_vals, start)
+            if word is None:          # not a value that we understand so skip it
+                key=bibtex_key.search(keys_and_vals, start)
+                continue
+            val=word.group()
+            end=word.end()
+
+        lkey=sys.intern(key.group(1).lower())  # keys always in lower case, and shared between entries
+        if lkey=='title':
+            val=bibup.fix_fonts(val)  # only fix fonts in the title, others assumed OK
+        fields.append((lkey,val))
+        key=bibtex_key.search(keys_and_vals, end)
+    return fields
+
+class Bibtex(dict):
     r"""
     The bibtex class holds all of the data for a bibtex entry for a manuscript.
-    It is called with a string <bib_string> that contains a bibtex entry and it
-    returns a dictionary with whistles for the bibtex entry together with some
-    methods for updating and printing the entry. As the bibtex file is a flat
-    text file, to extract the data from it we use a collection of regular
-    expressions which pull out the data key by key.
+    It is called with the publication type, citation key and fields of a bibtex
+    entry, as found by bibtex_entries(), and it returns a dictionary with
+    whistles for the bibtex entry together with some methods for updating and
+    printing the entry. As the bibtex file is a flat text file, to extract the
+    data from it we use a regular expression which pulls out the data key by key.
 
     The class contains mrlookup() and mathscinet() methods that attempt to
     update the bibtex entry by searching on the corresponding AMS databases for
@@ -227,84 +464,69 @@ class Bibtex(OrderedDict):
     extract the data from the bibtex file and from mrlookup and
     mathscient...perhaps we should be using pyquery or beautiful soup for the
     latter, but these regular expressions are certainly effective.
+
+    Dictionaries keep their insertion order, so the fields are written out in
+    the order that they were read. As there is one Bibtex instance per entry
+    the attributes are kept in slots.
     """
-    # A regular expression to extract a bibtex entry from a string. We assume that
-    # the pub_type is a word in [A-Za-z]* and allow the citation key and the
-    # contents of the bibtex entry to be fairly arbitrary and of the form: {cite_key, *}.
-    parse_bibtex_entry=re.compile(r'@(?P<pub_type>[A-Za-z]*)\s*\{\s*(?P<cite_key>\S*)\s*,\s*?(?P<keys_and_vals>.*\})[,\s]*\}', re.MULTILINE|re.DOTALL)
-
-    # To extract the keys and values we need to remove all spaces around equals
-    # signs because otherwise we are unable to cope with = inside a bibtex field.
-    keys_and_vals=re.compile(r'\s*=\s*')
-
-    # A regular expression to extract pairs of keys and values from a bibtex
-    # string. The syntax here is very lax: we assume that bibtex fields do not
-    # contain the string '={'.  From the AMS the format of a bibtex entry is
-    # much more rigid but we cannot assume that an arbitrary bibtex file will
-    # respect the AMS conventions.  There is a small complication in that we
-    # allow the value of each field to either be enclosed in braces or to be a
-    # single word.
-    bibtex_keys=re.compile(r'([A-Za-z]+)=(?:\{((?:[^=]|=(?!\{))+)\}|(\w+)),?\s*$', re.MULTILINE|re.DOTALL)
-
-    # A regular expression for extracting page numbers: <first page>-*<last page>
-    # or simply <page>.
-    page_nums=re.compile('(?P<apage>[0-9]*)-+(?P<zpage>[0-9]*)')
-
-    # For authors we match either "First Last" or "Last, First" with the
-    # existence of the comma being the crucial test because we want to allow
-    # compound surnames like De Morgan.
-    author=re.compile(r'(?P<Au>[\w\s\\\-\'"{}]+),\s[A-Z]|[\w\s\\\-\'"{}]+\s(?P<au>[\w\s\\\-\'"{}]+)',re.DOTALL)
-
-    def __init__(self, bib_string):
-        """
-        Given a string <bib_string> that contains a bibtex entry return the corresponding Bibtex class.
+    __slots__=('pub_type', 'cite_key', 'bib_string')
 
-        EXAMPLE:
+    def __init__(self, pub_type, cite_key, body):
         """
-        super(Bibtex, self).__init__()   # initialise as an OrderedDict
-        entry=self.parse_bibtex_entry.search(bib_string)
-        if entry is None:
-            self.cite_key=None
-            self.bib_string=bib_string
+        Given the strings <pub_type>, <cite_key> and <body> of a bibtex entry,
+        as yielded by bibtex_entries(), return the corresponding Bibtex class.
+        If <cite_key> is None then <body> is an entry that we cannot parse,
+        which is kept as it is.
+        """
+        super(Bibtex, self).__init__()
+        self.cite_key=cite_key
+        if cite_key is None:
+            self.bib_string=body
         else:
-            self.pub_type=entry.group('pub_type').strip().lower()
-            self.cite_key=entry.group('cite_key').strip()
-            keys_and_vals=self.keys_and_vals.sub('=',entry.group('keys_and_vals'))   # remove spaces around =
-            for (key,val,word) in self.bibtex_keys.findall(keys_and_vals):
-                if val=='':
-                    val=word                  # val matches {value} whereas word matches word
-                else:
-                    val=' '.join(val.split()) # remove any internal space from val
-                lkey=key.lower()              # keys always in lower case
-                if lkey=='title':
-                    self[lkey]=bibup.fix_fonts(val) # only fix fonts in the title, others assumed OK
-                else:
-                    self[lkey]=val
-
-            # guess whether this entry corresponds to a preprint
-            self.is_preprint=( ('pages' in self and self['pages'].lower() in ['preprint', 'to appear', 'in preparation'])
-                      or not ('pages' in self and 'journal' in self) )
+            self.pub_type=pub_type
+            self.update(bibtex_fields(body))
 
     def __str__(self):
         r"""
         Return a string for printing the bibtex entry.
         """
+        bib_string=io.StringIO()
+        self.write_to(bib_string)
+        return bib_string.getvalue()
+
+    def write_to(self, bibfile):
+        r"""
+        Write the bibtex entry to the file `bibfile`. The fields are written
+        one at a time so that we never build the whole entry as a string.
+        """
         if hasattr(self,'pub_type'):
-            return '@%s{%s,\n  %s\n}' % (self.pub_type.upper(), self.cite_key,
-                    ',\n  '.join('%s = {%s}'%(key,bibup.wrapped(self[key]))
-                     for key in self.keys() if key not in options.ignored_fields))
+            bibfile.write('@%s{%s,' % (self.pub_type.upper(), self.cite_key))
+            separator='\n  '
+            wrapped=bibup.wrapped
+            for (key,val) in self.items():
+                if key not in options.ignored_fields:
+                    bibfile.write('%s%s = {%s}' % (separator, key, val if wrapped is None else wrapped(val)))
+                    separator=',\n  '
+            bibfile.write('\n}')
         else:
-            return self.bib_string
+            bibfile.write(self.bib_string)
 
-    def __getitem__(self, key, default=''):
+    def __missing__(self, key):
         """
-        We override `__getitem__` so that `self[key]` returns `default` if the `self[key]`
+        We define `__missing__` so that `self[key]` returns '' if `self[key]`
         does not exist.
         """
-        try:
-            return OrderedDict.__getitem__(self, key)
-        except KeyError:
-            return default
+        return ''
+
+    @property
+    def is_preprint(self):
+        r"""
+        Guess whether this entry corresponds to a preprint. This is only needed
+        for the entries that we look up, and not for the entries returned by the
+        AMS, so it is worked out when it is used rather than in __init__.
+        """
+        pages=self.get('pages')
+        return pages is None or pages.lower() in preprint_pages or 'journal' not in self
 
     def has_valid_pub_type(self):
         r"""
@@ -324,21 +546,31 @@ class Bibtex(OrderedDict):
         """
         # query url with the search string
         try:
-            bibup.debug('S %s\n%s' % (url, '\n'.join('S %s=%s'%(s[0],s[1]) for s in search.items())))
-            lookup = urllib.urlopen(url, urllib.urlencode(search))
-            page=lookup.read()
-            lookup.close()   # close the url feed
-        except IOError:
+            if bibup.debugging:  # only build the search string when it is printed
+                bibup.debug('S %s\n%s' % (url, '\n'.join('S %s=%s'%(s[0],s[1]) for s in search.items())))
+            page=url_lookup(url, search)
+        except requests.RequestException:
             bib_error('unable to connect to %s' % url)
 
-        # attempt to match self with the bibtex entries returned by mrlookup
-        matches=[Bibtex(mr.groups(0)[0]) for mr in bibtex_entry.finditer(page)]
-        matches=[mr for mr in matches if mr is not None and mr.has_valid_pub_type()]
-        bibup.debug('MR number of matches=%d'%len(matches))
-        clean_ti=clean_title(self['title'])
-        bibup.debug('MR ti=%s.%s' % (clean_ti, ''.join('\nMR -->%s.'%clean_title(mr['title']) for mr in matches)))
-        if clean_ti!='':
-            matches=[mr for mr in matches if good_match(clean_ti, clean_title(mr['title']))]
+        # attempt to match self with the bibtex entries returned by mrlookup.
+        # Only the entries with a valid pub_type are parsed, as they are
+        # scanned, and their titles are cleaned and lower cased in the same pass
+        cleaned=[(mr, clean_title(mr['title']).lower())
+                    for mr in (Bibtex(pub_type, cite_key, body)
+                        for (pub_type, cite_key, body) in bibtex_entries(page.encode('utf-8'))
+                        if cite_key is not None)]
+        bibup.debug('MR number of matches=%d'%len(cleaned))
+        clean_ti=clean_title(self['title']).lower()
+        if bibup.debugging:  # only join the titles when they are printed
+            bibup.debug('MR ti=%s.%s' % (clean_ti, ''.join('\nMR -->%s.'%ti for (mr,ti) in cleaned)))
+        if clean_ti=='':
+            matches=[mr for (mr,ti) in cleaned]
+        else:
+            # skip titles whose lengths are too different to ever be a good
+            # match before calling good_matches
+            candidates=[(mr,ti) for (mr,ti) in cleaned if possible_match(clean_ti, ti)]
+            matches=[candidates[index][0] for index in
+                        good_matches(clean_ti, tuple(ti for (mr,ti) in candidates))]
         bibup.debug('MR number of clean matches=%d'%len(matches))
 
         if len(matches)==1:
@@ -362,7 +594,7 @@ class Bibtex(OrderedDict):
             if not self.is_preprint:
                 bibup.verbose("%s\n%s Didn't find %s=%s"%('-'*30,
                             '!' if self.is_preprint else '!', self.cite_key,
-                            self['title'][:40] if 'title' in self else '???'))
+                            self.get('title', '???')[:40]))
 
     def mrlookup(self):
         """
@@ -373,46 +605,53 @@ class Bibtex(OrderedDict):
         """
         # only check mrlookup for books or articles for which we don't already have an mrnumber field
         if not options.all and ('mrnumber' in self
-           or self.pub_type not in ['book','article','inproceedings','incollection']):
+           or self.pub_type not in ams_pub_types):
             return
 
         bibup.debug('='*30)
         search={'bibtex':'checked'}   # a dictionary that will contain the parameters for the mrlookup search
 
-        if 'pages' in self and not self.is_preprint:
-            pages=self.page_nums.search(self['pages'])
-            if not pages is None:
-                search['ipage']=pages.group('apage')  # first page
-                search['fpage']=pages.group('zpage')  # last page
-            elif self['pages'].isdigit():
-                search['ipage']=self['pages']  # first page
-                #search['fpage']=self['pages']  # last page
+        pages=self.get('pages')
+        if pages is not None and not self.is_preprint:
+            # pages are almost always of the form <first page>-*<last page>
+            (apage, dash, zpage)=pages.partition('-')
+            apage=apage.strip()
+            zpage=zpage.lstrip('-').strip()
+            if dash and apage.isdigit() and zpage.isdigit():
+                search['ipage']=apage  # first page
+                search['fpage']=zpage  # last page
+            elif pages.isdigit():
+                search['ipage']=pages  # first page
+                #search['fpage']=pages  # last page
 
         # the year is reliable only if we also have page numbers
-        if 'year' in self and (self.pub_type=='book' or 'ipage' in search):
-            search['year']=self['year']
+        year=self.get('year')
+        if year is not None and (self.pub_type=='book' or 'ipage' in search):
+            search['year']=year
 
         # mrlookup requires either an author or a title
-        if 'author' in self:
+        author=self.get('author')
+        if author is not None:
             # mrlookup is latex aware and it does a far better job of parsing
             # authors than we ever will, however, it only recognises authors in
             # the form "Last Name" -- and sometimes with a first initial as
             # well. So this is what we need to give it.
-            authors=''
-            aulist=re.sub(' and ','&',self['author'])
-            aulist=aulist.replace('~',' ')
-            for au in aulist.split('&'):
-                a=self.author.search(au.strip())
-                if not a is None:
-                    if a.group('au') is not None:
-                        authors+=' and '+a.group('au')    # First LAST
-                    else:
-                        authors+=' and '+a.group('Au')    # LAST, First
-            if len(authors)>5:
-                search['au']=authors[5:]
-
-        if 'title' in self and len(self['title'])>0 and (not 'ipage' in search or self.is_preprint):
-            search['ti']=clean_title(self['title'])
+            authors=[]
+            for au in author_separator.split(author.replace('~',' ')):
+                a=author_name.search(au.strip())
+                if a is not None:
+                    authors.append(a.group('au') or a.group('Au'))  # First LAST or LAST, First
+            if authors!=[]:
+                search['au']=' and '.join(authors)
+
+        title=self.get('title')
+        if title and ('ipage' not in search or self.is_preprint):
+            search['ti']=clean_title(title)
+
+        # without an author or a title mrlookup has nothing to search on
+        if not ('au' in search or 'ti' in search):
+            bibup.debug('Skipping %s: no author or title to search for' % self.cite_key)
+            return
 
         self.update_entry('http://www.ams.org/mrlookup', search)
 
@@ -420,9 +659,13 @@ class Bibtex(OrderedDict):
         """
         Use MathSciNet to check/update the entry using the mrnumber field, if it exists.
         """
-        if options.all or 'mrnumber' in self:
-            search={'fmt': 'bibtex', 'pg1': 'MR', 's1': self['mrnumber'].split()[0]}
-            self.update_entry('http://www.ams.org/mathscinet/search/publications.html', search, False)
+        # even with --all there is nothing to search for without an mrnumber
+        mrnumber=self['mrnumber'].split()
+        if mrnumber==[]:
+            bibup.debug('Skipping %s: no mrnumber' % self.cite_key)
+            return
+        search={'fmt': 'bibtex', 'pg1': 'MR', 's1': mrnumber[0]}
+        self.update_entry('http://www.ams.org/mathscinet/search/publications.html', search)
 
     def mref(self):
         """
@@ -430,13 +673,45 @@ class Bibtex(OrderedDict):
         Mref takes a free-form reference so we give it the whole entry to play with.
         """
         # only check mrlookup for books or articles for which we don't already have an mrnumber field
-        if not options.all and ('mrnumber' in self or self.pub_type not in ['book','article','inproceedings','incollection']):
+        if not options.all and ('mrnumber' in self or self.pub_type not in ams_pub_types):
             return
         search = {'mref-submit' : "Search", 'dataType': 'bibtex'}
         search['ref'] = ''.join("%s\n"% self[key] for key in self.keys())
 
         self.update_entry('https://mathscinet.ams.org/mathscinet-mref', search)
 
+def looked_up_entries(entries, lookups):
+    r"""
+    Submit the valid entries in `entries` to the thread pool `lookups` and
+    yield all of the entries, in their original order, as their lookups
+    finish. At most lookup_window entries per lookup thread are held back at
+    any time so the bibtex file is streamed through rather than read into
+    memory. If a lookup fails then the waiting lookups are cancelled and the
+    error is re-raised.
+    """
+    pending=collections.deque()
+    look_up=getattr(Bibtex, options.lookup)  # the same lookup method is used for every entry
+    try:
+        for bt in entries:
+            # other pub_types are possible, such as @comment{}, and these are not looked up
+            pending.append((bt, lookups.submit(look_up, bt) if bt.has_valid_pub_type() else None))
+            if len(pending)>lookup_window*options.jobs:
+                (bt, lookup)=pending.popleft()
+                if lookup is not None:
+                    lookup.result()   # wait for the lookup and re-raise any errors
+                yield bt
+        while pending:
+            (bt, lookup)=pending.popleft()
+            if lookup is not None:
+                lookup.result()
+            yield bt
+    except BaseException:
+        # if a lookup failed then there is no point waiting for the others
+        for (bt, lookup) in pending:
+            if lookup is not None:
+                lookup.cancel()
+        raise
+
 def process_options():
     r"""
     Set up and then parse the options to bibupdate using argparse.
@@ -488,6 +763,26 @@ def process_options():
         action='append',
         help='a string of bibtex fields to ignore'
     )
+    parser.add_argument('--cache',
+        type=str,
+        default=cache_file,
+        metavar='PATH',
+        help='cache the pages from the AMS in PATH'
+    )
+    parser.add_argument('--no-cache',
+        action='store_const',
+        const=':memory:',
+        dest='cache',
+        help='only cache the pages from the AMS while bibupdate is running'
+    )
+    parser.add_argument('-j','--jobs',
+        type=int,
+        default=lookup_threads,
+        action='store',
+        choices=NonnegativeIntegers(),
+        metavar='N',
+        help='run N lookups at the same time (default %d)' % lookup_threads
+    )
     parser.add_argument('-l','--log',
         default=sys.stdout,
         type=argparse.FileType('w'),
@@ -554,14 +849,22 @@ def process_options():
         # print documentation and exit
         bib_print(__doc__)
         sys.exit()
-    elif options.bibtexfile==None:
-        biberror('no bibtex file specified')
+    elif options.bibtexfile is None:
+        bib_error('no bibtex file specified')
 
     if len(options.ignored_fields)>4:
         # if any fields were added then don't ignore the first 4 fields.
-        options.ignored_fields=list(chain.from_iterable([i.lower().split()
-                                        for i in options.ignored_fields[4:]])
-        )
+        options.ignored_fields=options.ignored_fields[4:]
+    # at least one lookup has to run, and each lookup thread gets its own connection
+    if options.jobs==0:
+        parser.error('the number of jobs must be at least 1')
+    for protocol in ['http://', 'https://']:
+        session.mount(protocol, requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=options.jobs))
+
+    # the ignored fields are tested for every field of every entry, and the
+    # keys of the entries are always lower case
+    options.ignored_fields=frozenset(field for fields in options.ignored_fields
+                                           for field in fields.lower().split())
 
     # if check==True then we want to check everything
     if options.check:
@@ -569,9 +872,13 @@ def process_options():
 
     # define word wrapping when requested
     if options.wrap!=0:
-        bibup.wrapped=lambda field: '\n'.join(textwrap.wrap(field,options.wrap,subsequent_indent='\t'))
+        # one wrapper is shared by every field rather than creating one per call.
+        # Long words, such as urls, and hyphenated words are never split.
+        import textwrap  # only needed when wrapping
+        bibup.wrapped=textwrap.TextWrapper(width=options.wrap, subsequent_indent='\t',
+                                           break_long_words=False, break_on_hyphens=False).fill
     else:
-        bibup.wrapped=lambda field: field
+        bibup.wrapped=None  # write_to() skips wrapping altogether
 
     # define debugging, verbose and warning functions
     if options.debugging>0:
@@ -583,9 +890,9 @@ def process_options():
             import pudb
             pu.db
     else:
-        bibup.debug=lambda *arg: None
-    bibup.verbose=bib_print if options.quieter==2 else lambda *arg: None
-    bibup.warning=bib_print if options.quieter>=1 else lambda *arg: None
+        bibup.debug=no_op
+    bibup.verbose=bib_print if options.quieter==2 else no_op
+    bibup.warning=bib_print if options.quieter>=1 else no_op
 
     # a shorthand for fixed the fonts (to avoid an if-statement when calling it)
     bibup.fix_fonts=replace_fonts if not options.keep_fonts else lambda title: title
@@ -596,54 +903,76 @@ def main():
     """
     process_options()
 
+    # if we are checking for errors then we check EVERYTHING but, in this case,
+    # we don't need to create a new bibtex file
+    if options.check:
+        newfile=None
+    elif options.overwrite:
+        newfile=options.bibtexfile.name  # will be backed up below
+    elif options.outputfile is None:
+        # write updates to 'updated_'+filename
+        (dir, base)=os.path.split(options.bibtexfile.name)
+        newfile=os.path.join(dir, 'updated_'+base)
+    else:
+        newfile=options.outputfile
+
     # now we are ready to read the BibTeX file and start working
     try:
-        papers=options.bibtexfile.read()  # file opened by argparse
-        options.bibtexfile.close()
-        asterisk=papers.index('@')
-    except IOError:
+        papers=read_papers(options.bibtexfile, newfile)
+        options.bibtexfile.close()  # file opened by argparse
+        asterisk=papers.find(b'@')
+        if asterisk<0:              # no entries, so copy the whole file
+            asterisk=len(papers)
+    except (IOError, ValueError):
         bib_error('unable to open bibtex file %s' % options.bibtexfile.name)
 
-    # if we are checking for errors then we check EVERYTHING but, in this case,
-    # we don't need to create a new bibtex file
     if not options.check:
-        if options.overwrite:
-            newfile=options.filename.name  # will be backed up below
-        elif options.outputfile is None:
-            # write updates to 'updated_'+filename
-            dir=os.path.dirname(options.bibtexfile.name)
-            base=os.path.basename(options.bibtexfile.name)
-            newfile='{dir}updated_{base}'.format(dir='' if dir=='' else dir+'/',base=base)
-        else:
-            newfile=options.outputfile
-
         # backup the output file by adding .bak if it exists and is non-empty
         if os.path.isfile(newfile) and os.path.getsize(newfile)>0:
+            import shutil  # only needed for backups
             try:
                 shutil.copyfile(newfile,newfile+'.bak')
             except IOError:
-                biberror('unable to create backup file for %s'%newfile)
+                bib_error('unable to create backup file for %s'%newfile)
 
         # open newfile
         try:
-            newbibfile=open(newfile,'w')
-            newbibfile.write(papers[:asterisk]) # copy everything up to the first @
+            newbibfile=open(newfile,'w',encoding='utf-8',buffering=1<<20)
+            newbibfile.write(papers[:asterisk].decode('utf-8', 'replace')) # copy everything up to the first @
         except IOError:
             bib_error('unable to open new bibtex file %s' % newfile)
 
-    # we are now ready to start processing the papers from the bibtex file
-    for bibentry in bibtex_entry.finditer(papers[asterisk:]):
-        if not bibentry is None:
-            bt=Bibtex(bibentry.group())
-            # other pub_types are possible such as @comment{} we first check
-            if bt.has_valid_pub_type():
-                getattr(bt, options.lookup)()  # call lookup program
-
-        # now write the new (and hopefully) improved entry
-        if not options.check:
-            newbibfile.write('%s\n\n' % bt)
+    # The lookups spend almost all of their time waiting for the AMS so we run
+    # them in a pool of threads. The entries are parsed, looked up and written
+    # in their original order as a stream. The output is collected in memory
+    # and written 256 entries at a time.
+    try:
+        bibup.cache=open_cache(options.cache)
+    except (OSError, sqlite3.Error):
+        bib_error('unable to open the cache %s' % options.cache)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=options.jobs) as lookups:
+            entries=(Bibtex(pub_type, cite_key, body)
+                        for (pub_type, cite_key, body) in bibtex_entries(papers, asterisk))
+            if options.check:
+                # nothing is written so we only need to wait for the lookups
+                for bt in looked_up_entries(entries, lookups):
+                    pass
+            else:
+                updated=io.StringIO()
+                for (num, bt) in enumerate(looked_up_entries(entries, lookups), 1):
+                    bt.write_to(updated)
+                    updated.write('\n\n')
+                    if num%256==0:
+                        newbibfile.write(updated.getvalue())
+                        updated=io.StringIO()
+    finally:
+        # keep the pages that we did find, even if some lookups failed
+        bibup.cache.commit()
+        bibup.cache.close()
 
     if not options.check:
+        newbibfile.write(updated.getvalue())
         newbibfile.close()
 
 ##############################################################################
@@ -660,8 +989,8 @@ bibupdate
 
 {0.description}
 
-usage: bibupdate [-h|-H] [-a] [-c] [-f] [-i FIELDS] [-l LOG] [-m | -M] [-q] [-r]
-                 [-w LEN] bibtexfile [outputfile]
+usage: bibupdate [-h|-H] [-a] [--cache PATH] [--no-cache] [-c] [-f] [-i FIELDS]
+                 [-j N] [-l LOG] [-m | -M] [-q] [-r] [-w LEN] bibtexfile [outputfile]
 
 This is a command line tool for updating the entries in a BibTeX_ file using
 mrlookup_. By default bibupdate_ tries to update the entry for each paper
@@ -671,12 +1000,15 @@ disable future checking of an entry by giving it an empty ``mrnumber`` field).
 **Options**::
 
   -a, --all             update or validate ALL BibTeX entries
+  --cache PATH          cache the pages from the AMS in PATH
+  --no-cache            only cache the pages from the AMS while bibupdate is running
   -c, --check           check/verify all bibtex entries against a database
   -k, --keep_fonts      do NOT replace fonts \Bbb, \germ and \scr in titles
   -h, --help            show this help message and exit
   -H, --Help            print full program description
   -i FIELDS, --ignored-fields FIELDS
                         a string of bibtex fields to ignore
+  -j N, --jobs N        run N lookups at the same time (default 16)
   -l LOG, --log LOG     log messages to specified file (defaults to stdout)
   -o  --overwrite       overwrite existing bibtex file
   -q, --quieter         print fewer messages
@@ -750,6 +1082,21 @@ Options and defaults
   database if the entry does *not* have an ``mrnumber`` field. With this switch
   all entries are checked and updated.
 
+--cache PATH  Cache the pages from the AMS in PATH
+
+  The pages returned by mrlookup_ and MathSciNet_ are cached, for 30 days,
+  in an sqlite database so that rerunning bibupdate_ does not query the AMS
+  again for entries that have not changed. By default the cache is kept in
+  ~/.cache/bibupdate/mrlookup.sqlite. As a result, a paper that has only just
+  appeared on MathSciNet_ may not be found until the cached page expires. Use
+  --no-cache, or delete the cache, to look these papers up again.
+
+--no-cache  Only cache the pages from the AMS while bibupdate is running
+
+  The cache is kept in memory, and discarded when bibupdate_ finishes, so
+  every entry is looked up again. Entries with the same search within one run
+  still share a single lookup.
+
 -c --check      Check/validate all bibtex entries against a database
 
   Prints a list of entries in the BibTeX file that have fields different from
@@ -784,6 +1131,12 @@ Options and defaults
      bibupdate -i coden -i fjournal file.bib  # ignore coden and fjournal
      bibupdate -i "" file.bib                 # do not ignore any fields
 
+-j N, --jobs N  Run N lookups at the same time (default 16)
+
+  The lookups spend almost all of their time waiting for the AMS so, by
+  default, bibupdate_ runs 16 of them at the same time. Use -j 1 to look up
+  one entry at a time.
+
 -l LOG, --log LOG  Log output to file (defaults to stdout)
 
   Specify a log filename to use for the bibupdate_ messages.
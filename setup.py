@@ -3,8 +3,8 @@ from subprocess import call
 import bibupdate, datetime, sys
 
 install_requires = [
-  'fuzzywuzzy >= 0.2', 
-  'python-Levenshtein >= 0.12.2'
+  'rapidfuzz >= 1.0',
+  'requests >= 2.0'
 ]
 
 # need to do the following properly...there's no point checking the version